@@ -1,64 +1,187 @@
 import json
 import os
-from llm_utils import query_llama_with_validation
+import heapq
+from collections import defaultdict
+from operator import itemgetter
+from llm_utils import query_llama_with_validation, write_json, stack_json
+from billing_engine import (
+    get_recent_months, generate_mock_billing, normalize_billing,
+    save_mock_billing, billing_context, BILLING_INSTRUCTIONS
+)
 
 # Stage 3: Cost Analysis
 # Analyzes billing data and generates recommendations via LLM
 
-def analyze_costs_and_generate_recommendations(profile, billing):
+# Recommendation schema (checked on every LLM reply)
+_RECS_MIN_ITEMS = 5
+_RECS_MAX_ITEMS = 12 # Upper end of the "8-12 items" the prompts ask for
+_REC_REQUIRED = ("title", "service", "current_cost", "potential_savings")
+
+# Compact list of safe defaults (used only when the LLM returns too few items)
+_DEFAULT_RECS = (
+    {"title": "Configure Cloud Budget Alerts", "service": "Governance", "potential_savings": 0, "recommendation_type": "Governance", "cloud_providers": ["AWS", "GCP"], "description": "Set strict budget thresholds.", "steps": ["Create budget", "Set alert @ 80%"], "risk_level": "Low", "implementation_effort": "Low"},
+    {"title": "Enable Resource Tagging", "service": "Governance", "potential_savings": 0, "recommendation_type": "Governance", "cloud_providers": ["AWS", "Azure"], "description": "Tag resources by project.", "steps": ["Define tags", "Apply policy"], "risk_level": "Low", "implementation_effort": "Low"},
+    {"title": "Enable MFA", "service": "Security", "potential_savings": 0, "recommendation_type": "Security", "cloud_providers": ["AWS"], "description": "Secure root account.", "steps": ["Turn on MFA"], "risk_level": "Low", "implementation_effort": "Low"},
+    {"title": "Release Unused IPs", "service": "Networking", "potential_savings": 200, "recommendation_type": "Cleanup", "cloud_providers": ["AWS"], "description": "Release unattached Elastic IPs.", "steps": ["Find IPs", "Release"], "risk_level": "Low", "implementation_effort": "Low"},
+    {"title": "Delete Unattached EBS", "service": "Storage", "potential_savings": 500, "recommendation_type": "Cleanup", "cloud_providers": ["AWS"], "description": "Delete orphaned volumes.", "steps": ["Scan volumes", "Delete"], "risk_level": "Low", "implementation_effort": "Low"},
+    {"title": "Lease Privilege IAM", "service": "Security", "potential_savings": 0, "recommendation_type": "Security", "cloud_providers": ["AWS"], "description": "Audit permissions.", "steps": ["Review roles"], "risk_level": "Medium", "implementation_effort": "Medium"},
+    {"title": "Data Retention Policy", "service": "Governance", "potential_savings": 0, "recommendation_type": "Governance", "cloud_providers": ["AWS"], "description": "Auto-delete old logs.", "steps": ["Set lifecycle"], "risk_level": "Low", "implementation_effort": "Low"},
+)
+
+def _validate_recs(recs, is_sqlite=False):
     """
-    Main function to analyze costs and get 8-10 recommendations.
+    Schema check for the LLM reply. Errors name the exact problem so the retry can fix it.
+    Cheap whole-list checks run first; the per-item scan stops at the first bad item.
     """
+    if not isinstance(recs, list): return False, "Output must be a JSON list"
+    if len(recs) < _RECS_MIN_ITEMS: return False, f"Need {_RECS_MIN_ITEMS}+ items, got {len(recs)}"
+    for i, r in enumerate(recs):
+        if not isinstance(r, dict): return False, f"Item at index {i} is not an object"
+        missing = next((k for k in _REC_REQUIRED if k not in r), None)
+        if missing: return False, f"Missing field '{missing}' at index {i}"
+        # Logic check: No DB recs for SQLite projects
+        if is_sqlite and r.get("service") == "Database": return False, f"No DB recs for SQLite (index {i})"
+    return True, None
+
+def _repair_recs(recs):
+    """Keeps only complete, non-duplicate items (same title key as _process_recs)."""
+    if not isinstance(recs, list): return []
+    kept, seen = [], set()
+    for r in recs:
+        if not isinstance(r, dict) or any(k not in r for k in _REC_REQUIRED): continue
+        key = str(r["title"]).strip()[:15].lower()
+        if key in seen: continue
+        seen.add(key)
+        kept.append(r)
+    return kept
+
+def _recs_checks(is_sqlite):
+    """Returns (validate, repair) for a recommendations list."""
+    def validate(recs):
+        return _validate_recs(recs, is_sqlite)
+
+    def repair(recs):
+        # Drop the offending items locally instead of asking the LLM again
+        kept = _repair_recs(recs)
+        if is_sqlite: kept = [r for r in kept if r.get("service") != "Database"]
+        return kept
     
-    # 1. Handle SQLite (Runs on Compute, so remove DB costs)
+    return validate, repair
+
+def _is_sqlite(profile):
+    """SQLite runs on the app server, so it has no separate Database costs."""
     tech_stack = profile.get("tech_stack", {}) or {}
-    db_name = str(tech_stack.get("database", "")).lower()
-    is_sqlite = "sqlite" in db_name
-    
-    if is_sqlite:
-        db_cost = sum(r["cost_inr"] for r in billing if r["service"] == "Database")
-        billing = [r for r in billing if r["service"] != "Database"]
-        
-        # Add that cost back to Compute (since SQLite uses the VM's resources)
-        compute_recs = [r for r in billing if r["service"] == "Compute"]
-        if compute_recs and db_cost > 0:
-            avg_add = db_cost / len(compute_recs)
-            for r in compute_recs: r["cost_inr"] += avg_add
-
-    # 2. Financials
-    total_cost = sum(r.get("cost_inr", 0) for r in billing)
-    months = len({r["month"] for r in billing}) or 1
-    avg_monthly = total_cost / months
+    return "sqlite" in str(tech_stack.get("database", "")).lower()
+
+def _cost_summary(profile, billing):
+    """Monthly averages and per-service breakdown of the billing records."""
+    is_sqlite = _is_sqlite(profile)
     
-    # Service Breakdown
-    services = {}
+    # Single pass. SQLite runs on Compute, so DB rows are dropped and their
+    # cost is added to the Compute total (since SQLite uses the VM's resources)
+    total_cost = 0.0
+    month_set = set()
+    services = defaultdict(float)
+    db_cost = 0
     for r in billing:
         svc = r.get("service", "Unknown")
-        services[svc] = services.get(svc, 0) + r.get("cost_inr", 0)
-    avg_breakdown = {k: v/months for k, v in services.items()}
-
+        cost = r.get("cost_inr", 0)
+        if is_sqlite and svc == "Database":
+            db_cost += cost
+            continue
+        total_cost += cost
+        month_set.add(r["month"])
+        services[svc] += cost
+        
+    if db_cost > 0 and "Compute" in services:
+        services["Compute"] += db_cost
+        total_cost += db_cost
+        
+    months = len(month_set) or 1
+    avg_monthly = total_cost / months
     budget = profile.get("budget_inr_per_month", 0)
-    variance = avg_monthly - budget
+    
+    return {
+        "is_sqlite": is_sqlite,
+        "avg_monthly": avg_monthly,
+        "budget": budget,
+        "variance": avg_monthly - budget,
+        "avg_breakdown": {k: v/months for k, v in services.items()}
+    }
 
-    # 3. LLM Generation
-    prompt = _get_analysis_prompt(profile, avg_monthly, budget, avg_breakdown, tech_stack)
+def analyze_costs_and_generate_recommendations(profile, billing):
+    """
+    Main function to analyze costs and get 8-10 recommendations.
+    """
     
-    def validate(recs):
-        if not isinstance(recs, list) or len(recs) < 5: return False, "Need 5+ items"
-        required = ["title", "service", "current_cost", "potential_savings"]
-        for i, r in enumerate(recs):
-            if not all(k in r for k in required): return False, f"Missing fields at index {i}"
-            # Logic check: No DB recs for SQLite projects
-            if is_sqlite and r.get("service") == "Database": return False, "No DB recs for SQLite"
-        return True, None
+    # 1. Financials & Service Breakdown
+    summary = _cost_summary(profile, billing)
+    tech_stack = profile.get("tech_stack", {}) or {}
+
+    # 2. LLM Generation
+    prompt = _get_analysis_prompt(profile, summary["avg_monthly"], summary["budget"], summary["avg_breakdown"], tech_stack)
+    validate, repair = _recs_checks(summary["is_sqlite"])
 
     print("Generating recommendations...")
-    raw_recs = query_llama_with_validation(prompt, validate, max_retries=3) or []
+    # The prompt asks for at most 12 recs; stop the stream there (trailing text and surplus items are skipped).
+    # Not at the report's 10: _process_recs filters duplicates/unsupported recs before it caps.
+    raw_recs = query_llama_with_validation(prompt, validate, max_retries=3, speculative=2, max_items=_RECS_MAX_ITEMS, repair_fn=repair) or []
 
-    # 4. Post-Process (Filter & Fill Gaps)
-    final_recs = _process_recs(raw_recs, profile, is_sqlite, avg_monthly)
+    return _build_report(profile, summary, raw_recs)
 
-    # 5. Final Calculations
+def generate_billing_and_recs(profile):
+    """
+    Fused Stage 2 + 3: a single LLM call returns both billing records and recommendations.
+    Returns (billing, report). Falls back to the two-call pipeline if the joint reply is unusable;
+    (None, None) if no billing records could be generated at all.
+    """
+    budget = profile.get("budget_inr_per_month", 5000)
+    months = get_recent_months(4)
+    is_sqlite = _is_sqlite(profile)
+    
+    prompt = _get_joint_prompt(profile, budget, months, is_sqlite)
+    validate_recs, repair_recs = _recs_checks(is_sqlite)
+    
+    def validate(data):
+        if not isinstance(data, dict) or not isinstance(data.get("billing"), list):
+            return False, 'Output must be an object with "billing" and "recommendations" lists'
+        # normalize_billing drops records outside the requested months (e.g. copied from the example)
+        if not any(isinstance(r, dict) and r.get("month") in months and "service" in r and "cost_inr" in r
+                   for r in data["billing"]):
+            return False, f'"billing" must contain records with "month", "service" and "cost_inr" for the months {", ".join(months)}'
+        return validate_recs(data.get("recommendations"))
+    
+    def repair(data):
+        if not isinstance(data, dict): return data # Nothing to repair locally; retry with feedback
+        return {**data, "recommendations": repair_recs(data.get("recommendations"))}
+
+    print("Generating billing records and recommendations...")
+    data = query_llama_with_validation(prompt, validate, max_retries=2, max_tokens=5000, repair_fn=repair)
+    
+    if data:
+        billing = normalize_billing(data["billing"], budget, months)
+        if billing:
+            return billing, _build_report(profile, _cost_summary(profile, billing), data["recommendations"])
+        print("Joint billing had no usable records.")
+    else:
+        print("Joint generation failed.")
+    
+    print("Running stages separately...")
+    billing = generate_mock_billing(profile)
+    if not billing:
+        return None, None
+    return billing, analyze_costs_and_generate_recommendations(profile, billing)
+
+def _build_report(profile, summary, raw_recs):
+    """Post-processes raw LLM recs and assembles the final report."""
+    avg_monthly = summary["avg_monthly"]
+    avg_breakdown = summary["avg_breakdown"]
+    variance = summary["variance"]
+    
+    # 1. Post-Process (Filter & Fill Gaps)
+    final_recs = _process_recs(raw_recs, profile, summary["is_sqlite"], avg_monthly)
+
+    # 2. Final Calculations
     total_save = sum(r["potential_savings"] for r in final_recs)
     save_pct = (total_save / avg_monthly * 100) if avg_monthly else 0
     
@@ -69,14 +192,14 @@ def analyze_costs_and_generate_recommendations(profile, billing):
         save_pct = 35.0
 
     # Identifies high cost services (Top 3)
-    sorted_services = sorted(avg_breakdown.items(), key=lambda x: x[1], reverse=True)[:3]
+    sorted_services = heapq.nlargest(3, avg_breakdown.items(), key=itemgetter(1))
     high_cost_services = {k: round(v, 2) for k, v in sorted_services}
 
     return {
         "project_name": profile.get("name"),
         "analysis": {
             "total_monthly_cost": round(avg_monthly, 2),
-            "budget": budget,
+            "budget": summary["budget"],
             "budget_variance": round(variance, 2),
             "service_costs": {k: round(v, 2) for k, v in avg_breakdown.items()},
             "high_cost_services": high_cost_services,
@@ -113,106 +236,144 @@ def _process_recs(recs, profile, is_sqlite, total_cost):
             cleaned.append(r)
             seen.add(key)
             
-    recs = sorted(cleaned, key=lambda x: x["potential_savings"], reverse=True)
+    recs = sorted(cleaned, key=itemgetter("potential_savings"), reverse=True)
 
     # Ensure minimum number of recommendations
     if len(recs) < 6:
         print(f"Only found {len(recs)} items. Adding defaults to meet report requirements.")
-        # Compact list of safe defaults
-        defaults = [
-            {"title": "Configure Cloud Budget Alerts", "service": "Governance", "potential_savings": 0, "recommendation_type": "Governance", "cloud_providers": ["AWS", "GCP"], "description": "Set strict budget thresholds.", "steps": ["Create budget", "Set alert @ 80%"], "risk_level": "Low", "implementation_effort": "Low"},
-            {"title": "Enable Resource Tagging", "service": "Governance", "potential_savings": 0, "recommendation_type": "Governance", "cloud_providers": ["AWS", "Azure"], "description": "Tag resources by project.", "steps": ["Define tags", "Apply policy"], "risk_level": "Low", "implementation_effort": "Low"},
-            {"title": "Enable MFA", "service": "Security", "potential_savings": 0, "recommendation_type": "Security", "cloud_providers": ["AWS"], "description": "Secure root account.", "steps": ["Turn on MFA"], "risk_level": "Low", "implementation_effort": "Low"},
-            {"title": "Release Unused IPs", "service": "Networking", "potential_savings": 200, "recommendation_type": "Cleanup", "cloud_providers": ["AWS"], "description": "Release unattached Elastic IPs.", "steps": ["Find IPs", "Release"], "risk_level": "Low", "implementation_effort": "Low"},
-            {"title": "Delete Unattached EBS", "service": "Storage", "potential_savings": 500, "recommendation_type": "Cleanup", "cloud_providers": ["AWS"], "description": "Delete orphaned volumes.", "steps": ["Scan volumes", "Delete"], "risk_level": "Low", "implementation_effort": "Low"},
-            {"title": "Lease Privilege IAM", "service": "Security", "potential_savings": 0, "recommendation_type": "Security", "cloud_providers": ["AWS"], "description": "Audit permissions.", "steps": ["Review roles"], "risk_level": "Medium", "implementation_effort": "Medium"},
-            {"title": "Data Retention Policy", "service": "Governance", "potential_savings": 0, "recommendation_type": "Governance", "cloud_providers": ["AWS"], "description": "Auto-delete old logs.", "steps": ["Set lifecycle"], "risk_level": "Low", "implementation_effort": "Low"}
-        ]
         
-        for d in defaults:
+        for d in _DEFAULT_RECS:
             if len(recs) >= 6: break
             key = d["title"][:15].lower()
             if key not in seen:
-                recs.append(d)
+                recs.append(dict(d)) # Shallow copy: savings may be rescaled later
                 seen.add(key)
     
     return recs[:10]
 
+# Static prompt parts: identical bytes on every call so provider-side prompt caching can
+# reuse them. Project data is appended after these prefixes, never interleaved.
+_REC_EXAMPLE = """[{
+  "title": "Migrate MongoDB to Open-Source MongoDB",
+  "service": "MongoDB",
+  "current_cost": 900,
+  "potential_savings": 450,
+  "recommendation_type": "open_source",
+  "description": "Migrate to open-source MongoDB, reducing costs and improving flexibility.",
+  "implementation_effort": "medium",
+  "risk_level": "medium",
+  "steps": [
+    "Assess MongoDB usage and determine if open-source is suitable",
+    "Migrate to open-source MongoDB, ensuring data integrity",
+    "Update application code to accommodate open-source MongoDB"
+  ],
+  "cloud_providers": [
+    "AWS",
+    "Azure",
+    "GCP"
+  ]
+}]"""
+
+_ANALYSIS_RULES = """INSTRUCTIONS:
+1. Generate 8-12 items. Mix Technical, Governance, Security, and Cleanup.
+
+2. CLOUD CONTEXT:
+   - For "Rightsizing", "Security", and "Cleanup", use services native to the PRIMARY CLOUD PROVIDER (e.g., if AWS use CloudWatch/EC2; if Azure use Monitor/VMs).
+   - For "Alternative Provider", you MUST suggest moving AWAY from the PRIMARY CLOUD PROVIDER (e.g. to DigitalOcean or Wasabi).
+
+3. MANDATORY MULTI-CLOUD STRATEGY:
+   - For generic advice that applies everywhere, list ["AWS", "Azure", "GCP"].
+   - You MUST include at least 2 specific "Alternative Provider" recommendations.
+
+3. Focus on:
+   - Free Tier (if budget < 10k)
+   - Open Source (if using paid Managed DBs)
+   - Rightsizing (for general Compute)
+
+4. Fill gaps with Governance items (Tagging, Alerts) if needed.
+5. Anti-Patterns: No "Transfer Acceleration", No "SQLite DB Optimization".
+"""
+
+_STATIC_ANALYSIS_PREFIX = f"""You are a cloud cost optimization expert. Analyze the billing data in the PROJECT CONTEXT and generate 8-12 optimization candidates.
+
+{_ANALYSIS_RULES}
+Output JSON list ONLY. Format:
+{_REC_EXAMPLE}
+"""
+
+# Billing record shape for the joint prompt: no concrete month to copy, no top-level array
+_JOINT_BILLING_RECORD = """{
+  "month": "<one of the Months to Cover, YYYY-MM>",
+  "service": "EC2",
+  "resource_id": "i-ecommerce-web-01",
+  "region": "ap-south-1",
+  "usage_type": "Linux/UNIX (on-demand)",
+  "usage_quantity": 720,
+  "unit": "hours",
+  "cost_inr": 900,
+  "desc": "Ecommerce web server"
+}"""
+
+_STATIC_JOINT_PREFIX = f"""You are a Cloud Billing Simulation Engine and a cloud cost optimization expert.
+Answer in two parts, returned together as ONE JSON object (see FINAL OUTPUT).
+
+PART 1 - BILLING SIMULATION:
+Generate realistic billing records for the cloud project described in the PROJECT CONTEXT.
+
+{BILLING_INSTRUCTIONS}
+Billing record format (each record is one item of the "billing" list):
+{_JOINT_BILLING_RECORD}
+
+PART 2 - COST OPTIMIZATION:
+Analyze the billing records you generated against the budget and generate 8-12 optimization candidates.
+
+{_ANALYSIS_RULES}
+Recommendation format:
+{_REC_EXAMPLE}
+
+FINAL OUTPUT: ONE JSON object containing both parts:
+{{"billing": [ ...billing records... ], "recommendations": [ ...recommendations... ]}}
+"""
+
+def _primary_cloud(stack):
+    """Detect Cloud Provider (defaults to AWS)."""
+    stack_text = str(stack).lower()
+    if "azure" in stack_text: return "Azure"
+    if "gcp" in stack_text or "google" in stack_text: return "GCP"
+    return "AWS"
+
 def _get_analysis_prompt(profile, monthly_cost, budget, breakdown, stack):
     """Returns the complex LLM prompt."""
     reqs = ", ".join(profile.get("non_functional_requirements", []))
     variance = monthly_cost - budget
     status = "OVER" if variance > 0 else "UNDER"
     
-    # Template Structure
-    example = """
-    [{
-      "title": "Migrate MongoDB to Open-Source MongoDB",
-      "service": "MongoDB",
-      "current_cost": 900,
-      "potential_savings": 450,
-      "recommendation_type": "open_source",
-      "description": "Migrate to open-source MongoDB, reducing costs and improving flexibility.",
-      "implementation_effort": "medium",
-      "risk_level": "medium",
-      "steps": [
-        "Assess MongoDB usage and determine if open-source is suitable",
-        "Migrate to open-source MongoDB, ensuring data integrity",
-        "Update application code to accommodate open-source MongoDB"
-      ],
-      "cloud_providers": [
-        "AWS",
-        "Azure",
-        "GCP"
-      ]
-    }]
-    """
+    return f"""{_STATIC_ANALYSIS_PREFIX}
+PROJECT CONTEXT:
+- Project: {profile.get('name')}
+- Stack: {stack_json(stack)}
+- Reqs: {reqs}
+- PRIMARY CLOUD PROVIDER: {_primary_cloud(stack)}
+- Monthly: ₹{monthly_cost:,.0f}
+- Budget: ₹{budget:,.0f} ({status} by {abs(variance):,.0f})
 
-    # Detect Cloud Provider
-    stack_text = str(stack).lower()
-    primary_cloud = "AWS" # Default
-    if "azure" in stack_text: primary_cloud = "Azure"
-    elif "gcp" in stack_text or "google" in stack_text: primary_cloud = "GCP"
-    
-    return f"""You are a cloud cost optimization expert. Analyze the billing data and generate 8-12 optimization candidates.
-    
-    Project: {profile.get('name')}
-    Stack: {json.dumps(stack)}
-    Reqs: {reqs}
-    Primary Cloud: {primary_cloud}
-    
-    Cost Context:
-    - Monthly: ₹{monthly_cost:,.0f}
-    - Budget: ₹{budget:,.0f} ({status} by {abs(variance):,.0f})
-    
-    Breakdown: {json.dumps(breakdown, indent=2)}
-    
-    INSTRUCTIONS:
-    1. Generate 8-12 items. Mix Technical, Governance, Security, and Cleanup.
-    
-    2. CLOUD CONTEXT:
-       - For "Rightsizing", "Security", and "Cleanup", usage services native to {primary_cloud} (e.g., if AWS use CloudWatch/EC2; if Azure use Monitor/VMs).
-       - For "Alternative Provider", you MUST suggest moving AWAY from {primary_cloud} (e.g. to DigitalOcean or Wasabi).
-       
-    3. MANDATORY MULTI-CLOUD STRATEGY:
-       - For generic advice that applies everywhere, list ["AWS", "Azure", "GCP"].
-       - You MUST include at least 2 specific "Alternative Provider" recommendations.
-    
-    3. Focus on:
-       - Free Tier (if budget < 10k)
-       - Open Source (if using paid Managed DBs)
-       - Rightsizing (for general Compute)
-       
-    4. Fill gaps with Governance items (Tagging, Alerts) if needed.
-    5. Anti-Patterns: No "Transfer Acceleration", No "SQLite DB Optimization".
+Breakdown: {json.dumps(breakdown, indent=2)}
+
+Output JSON list ONLY.
+"""
+
+def _get_joint_prompt(profile, budget, months, is_sqlite):
+    """Billing simulation + recommendations in one prompt, with a combined output object."""
+    reqs = ", ".join(profile.get("non_functional_requirements", []))
     
-    Output JSON list ONLY. Format:
-    {example}
-    """
+    return f"""{_STATIC_JOINT_PREFIX}
+{billing_context(profile, budget, months, is_sqlite)}- Reqs: {reqs}
+
+Return ONLY the JSON object.
+"""
 
 def save_cost_report(report, filename="cost_optimization_report.json"):
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(report, f, indent=2, ensure_ascii=False)
+    write_json(report, filename)
     print(f"Report saved to {filename}")
 
 def display_report_summary(report):
@@ -260,3 +421,22 @@ def run_cost_analysis():
         display_report_summary(report)
         return report
     return None
+
+def run_full_analysis():
+    """Stages 2 + 3 with a single LLM call. Writes both billing and report files."""
+    print("\n--- Running Stage 2 + 3 (Billing & Analysis) ---")
+    if not os.path.exists("project_profile.json"):
+        print("Missing project_profile.json")
+        return None
+
+    with open("project_profile.json", 'r') as f: profile = json.load(f)
+    print(f"Project: {profile.get('name')} | Budget: ₹{profile.get('budget_inr_per_month', 0):,}")
+    
+    billing, report = generate_billing_and_recs(profile)
+    if not billing:
+        print("Generation failed.")
+        return None
+    save_mock_billing(billing)
+    save_cost_report(report)
+    display_report_summary(report)
+    return report
@@ -6,14 +6,15 @@ Generates realistic billing records via LLM and enforces strict budget alignment
 import json
 import os
 import random
+import sys
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from llm_utils import query_llama_json
+from llm_utils import query_llama_json, write_json, stack_json
 
 def get_recent_months(n=4):
     """Returns list of last n months (YYYY-MM)."""
-    now = datetime.now().replace(day=1)
-    return [(now - relativedelta(months=i)).strftime("%Y-%m") for i in reversed(range(n))]
+    now = datetime.now()
+    current = now.year * 12 + (now.month - 1) # Months since year 0
+    return [f"{m // 12:04d}-{m % 12 + 1:02d}" for m in range(current - n + 1, current + 1)]
 
 def generate_mock_billing(profile):
     """
@@ -33,7 +34,14 @@ def generate_mock_billing(profile):
     # Validation: Ensure it returns a list
     raw_recs = query_llama_json(prompt, max_tokens=2500)
     
-    # 3. Validate & Sanitize
+    # 3. Validate, Sanitize & Normalize
+    return normalize_billing(raw_recs, budget, months)
+
+def normalize_billing(raw_recs, budget, months):
+    """
+    Repairs LLM billing records and scales each month to the budget.
+    Falls back to deterministic data if nothing usable came back.
+    """
     if not raw_recs or not isinstance(raw_recs, list):
         print("LLM error. Using fallback data.")
         return _generate_fallback(budget, months)
@@ -43,20 +51,23 @@ def generate_mock_billing(profile):
     
     for r in raw_recs:
         # Basic data repair
-        if not all(k in r for k in required): continue
+        if not isinstance(r, dict) or not all(k in r for k in required): continue
         r.setdefault("region", "ap-south-1")
         r.setdefault("usage_type", "Standard")
         r.setdefault("desc", f"{r['service']} usage")
         
         try:
             r["cost_inr"] = int(float(r["cost_inr"]))
+            # Interned: service/month are the grouping keys in normalization and _cost_summary
+            if isinstance(r["service"], str): r["service"] = sys.intern(r["service"])
+            if isinstance(r["month"], str): r["month"] = sys.intern(r["month"])
             valid_recs.append(r)
         except: continue
 
     if not valid_recs:
         return _generate_fallback(budget, months)
 
-    # 4. Budget Normalization
+    # Budget Normalization
     # Scale costs to roughly match the budget
     records_by_month = {m: [] for m in months}
     for r in valid_recs:
@@ -78,46 +89,79 @@ def generate_mock_billing(profile):
     # Return limited number of records
     return final_records[:20]
 
+# Fallback line items: (service, budget share, desc, resource_id, usage_type, unit, usage_quantity)
+# Distribute budget: Compute 40%, DB 30%, Storage 15%, Net 10%, Monitor 5%
+_FALLBACK_TEMPLATE = (
+    ("Compute", 0.4, "App Server Fleet", "i-app-prod-01", "On-Demand Linux", "hours", 720),
+    ("Database", 0.3, "Primary DB Instance", "db-prod-01", "RDS Standard", "hours", 720),
+    ("Storage", 0.15, "Object Storage", "vol-data-01", "Standard Storage", "GB-Mo", 500),
+    ("Networking", 0.1, "Data Transfer", "net-nat-01", "Data Transfer Out", "GB", 1000),
+    ("Monitoring", 0.05, "Cloud Watcher", "mon-main-01", "Metrics", "Reqs", 1000000),
+)
+
 def _generate_fallback(budget, months):
     """Deterministic fallback data generation."""
     recs = []
-    # Distribute budget: Compute 40%, DB 30%, Storage 15%, Net 10%, Monitor 5%
     for m in months:
-        # 1. Compute
-        recs.append({
-            "month": m, "service": "Compute", "cost_inr": int(budget*0.4), 
-            "desc": "App Server Fleet", "region": "ap-south-1",
-            "resource_id": "i-app-prod-01", "usage_type": "On-Demand Linux", "unit": "hours", "usage_quantity": 720
-        })
-        # 2. Database
-        recs.append({
-            "month": m, "service": "Database", "cost_inr": int(budget*0.3), 
-            "desc": "Primary DB Instance", "region": "ap-south-1",
-            "resource_id": "db-prod-01", "usage_type": "RDS Standard", "unit": "hours", "usage_quantity": 720
-        })
-        # 3. Storage
-        recs.append({
-            "month": m, "service": "Storage", "cost_inr": int(budget*0.15), 
-            "desc": "Object Storage", "region": "ap-south-1",
-            "resource_id": "vol-data-01", "usage_type": "Standard Storage", "unit": "GB-Mo", "usage_quantity": 500
-        })
-        # 4. Networking
-        recs.append({
-            "month": m, "service": "Networking", "cost_inr": int(budget*0.1), 
-            "desc": "Data Transfer", "region": "ap-south-1",
-            "resource_id": "net-nat-01", "usage_type": "Data Transfer Out", "unit": "GB", "usage_quantity": 1000
-        })
-        # 5. Monitoring
-        recs.append({
-            "month": m, "service": "Monitoring", "cost_inr": int(budget*0.05), 
-            "desc": "Cloud Watcher", "region": "ap-south-1",
-            "resource_id": "mon-main-01", "usage_type": "Metrics", "unit": "Reqs", "usage_quantity": 1000000
-        })
+        for svc, share, desc, rid, usage_type, unit, qty in _FALLBACK_TEMPLATE:
+            recs.append({
+                "month": m, "service": svc, "cost_inr": int(budget*share),
+                "desc": desc, "region": "ap-south-1",
+                "resource_id": rid, "usage_type": usage_type, "unit": unit, "usage_quantity": qty
+            })
     return recs[:20]
 
+# Static prompt prefix: identical bytes on every call so provider-side prompt caching can reuse it.
+# Everything project-specific goes in billing_context(), after this prefix.
+# Shared with the joint Stage 2+3 prompt in analyzer.py
+BILLING_INSTRUCTIONS = """INSTRUCTIONS:
+1. Generate exactly 15-20 billing records distributed across the 4 months.
+2. STRICTLY use services valid for the PRIMARY CLOUD PROVIDER (e.g., if AWS use EC2/S3/RDS; if Azure use VMs/Blob/SQL).
+3. VARY usage and costs slightly month-to-month (don't make them identical).
+3. Use REALISTIC resource names and descriptions (e.g., "db-prod-replica-01", "High-IOPS SSD").
+4. Services to Include: Compute, Storage, Networking, Monitoring (AND Database, unless the project uses SQLite).
+5. COSTING: Try to aim for the monthly budget, but accuracy isn't critical (math will be fixed later).
+"""
+
+STATIC_BILLING_PREFIX = f"""You are a Cloud Billing Simulation Engine.
+Generate a realistic JSON billing invoice for the cloud project described in the PROJECT CONTEXT.
+
+{BILLING_INSTRUCTIONS}
+REQUIRED JSON STRUCTURE:
+[
+  {{
+    "month": "2025-01",
+    "service": "EC2",
+    "resource_id": "i-ecommerce-web-01",
+    "region": "ap-south-1",
+    "usage_type": "Linux/UNIX (on-demand)",
+    "usage_quantity": 720,
+    "unit": "hours",
+    "cost_inr": 900,
+    "desc": "Ecommerce web server"
+  }},
+  {{
+    "month": "2025-01",
+    "service": "EC2",
+    "resource_id": "i-ecommerce-api-01",
+    "region": "ap-south-1",
+    "usage_type": "Linux/UNIX (on-demand)",
+    "usage_quantity": 360,
+    "unit": "hours",
+    "cost_inr": 450,
+    "desc": "Ecommerce API server"
+  }},
+  ...
+]
+"""
+
 def _get_billing_prompt(profile, budget, months, is_sqlite):
     """Constructs the prompt."""
-    tech_str = json.dumps(profile.get("tech_stack", {}) or {})
+    return f"{STATIC_BILLING_PREFIX}\n{billing_context(profile, budget, months, is_sqlite)}\nReturn ONLY the JSON array.\n"
+
+def billing_context(profile, budget, months, is_sqlite):
+    """Project-specific part of the billing prompt (also reused by the joint Stage 2+3 prompt)."""
+    tech_str = stack_json(profile.get("tech_stack"))
     months_str = ", ".join(months)
 
     # Detect Cloud Provider
@@ -128,60 +172,18 @@ def _get_billing_prompt(profile, budget, months, is_sqlite):
     elif "digitalocean" in stack_text or "ocean" in stack_text: primary_cloud = "DigitalOcean"
     elif "oracle" in stack_text: primary_cloud = "Oracle Cloud"
     
-    return f"""
-    You are a Cloud Billing Simulation Engine.
-    Generate a realistic JSON billing invoice for a cloud project.
-    
-    PROJECT CONTEXT:
-    - Name: "{profile.get('name')}"
-    - Tech Stack: {tech_str}
-    - Budget Goal: ~{budget} INR/month (Total ~{budget * 4} for 4 months)
-    - Months to Cover: {months_str}
-    - Uses SQLite? {"Yes (No Database costs)" if is_sqlite else "No"}
-    - PRIMARY CLOUD PROVIDER: {primary_cloud}
-    
-    INSTRUCTIONS:
-    1. Generate exactly 15-20 billing records distributed across the 4 months.
-    2. STRICTLY usage services valid for {primary_cloud} (e.g., if AWS use EC2/S3/RDS; if Azure use VMs/Blob/SQL).
-    3. VARY usage and costs slightly month-to-month (don't make them identical).
-    3. Use REALISTIC resource names and descriptions (e.g., "db-prod-replica-01", "High-IOPS SSD").
-    4. Services to Include: Compute, Storage, Networking, Monitoring. {"(AND Database)" if not is_sqlite else ""}
-    5. COSTING: Try to aim for the monthly budget, but accuracy isn't critical (math will be fixed later).
-    
-    REQUIRED JSON STRUCTURE:
-    [
-      {{
-        "month": "2025-01",
-        "service": "EC2",
-        "resource_id": "i-ecommerce-web-01",
-        "region": "ap-south-1",
-        "usage_type": "Linux/UNIX (on-demand)",
-        "usage_quantity": 720,
-        "unit": "hours",
-        "cost_inr": 900,
-        "desc": "Ecommerce web server"
-      }},
-      {{
-        "month": "2025-01",
-        "service": "EC2",
-        "resource_id": "i-ecommerce-api-01",
-        "region": "ap-south-1",
-        "usage_type": "Linux/UNIX (on-demand)",
-        "usage_quantity": 360,
-        "unit": "hours",
-        "cost_inr": 450,
-        "desc": "Ecommerce API server"
-      }},
-      ...
-    ]
-    
-    Return ONLY the JSON array.
-    """
+    return f"""PROJECT CONTEXT:
+- Name: "{profile.get('name')}"
+- Tech Stack: {tech_str}
+- Budget Goal: ~{budget} INR/month (Total ~{budget * 4} for 4 months)
+- Months to Cover: {months_str}
+- Uses SQLite? {"Yes (No Database costs)" if is_sqlite else "No"}
+- PRIMARY CLOUD PROVIDER: {primary_cloud}
+"""
 
 def save_mock_billing(records, filename="mock_billing.json"):
     """Helper to save billing records to JSON."""
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(records, f, indent=2, ensure_ascii=False)
+    write_json(records, filename)
     print(f"Generated {len(records)} records. Saved to {filename}")
     
     # Quick Summary
@@ -6,9 +6,22 @@ Handles interactions with Hugging Face Inference API.
 import os
 import json
 import re
-import requests
+import copy
+import atexit
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from dotenv import load_dotenv
 
+try:
+    import orjson # Optional: faster JSON parsing/serialization
+except ImportError:
+    orjson = None
+
+_json_loads = orjson.loads if orjson else json.loads
+
 # Load env immediately
 load_dotenv()
 
@@ -25,74 +38,383 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
-def query_llama(prompt, max_tokens=1000, temperature=0.1):
+MODEL = "meta-llama/Llama-3.1-8B-Instruct"
+
+# Shared HTTP session: keep-alive reuses the TLS connection across calls,
+# and transient gateway errors are retried at the transport level.
+# Built on first use so CLI paths that never call the LLM skip importing requests.
+_session = None
+_session_lock = threading.Lock()
+
+def _get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            
+            _session = requests.Session()
+            _session.headers.update(HEADERS)
+            _session.mount("https://", HTTPAdapter(
+                pool_connections=2,
+                pool_maxsize=4,
+                max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=["POST"])
+            ))
+    return _session
+
+# JSON extraction patterns
+_MD_RE = re.compile(r'```json\s*(.*?)\s*```', re.DOTALL)
+_BRACE_RE = re.compile(r'[\[\{]')
+
+# Response Cache (opt-in via LLM_CACHE_ENABLED=1)
+# Only near-deterministic calls are cached, so re-runs of Stage 2/3 skip the API.
+CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+CACHE_FILE = os.path.join("data", "llm_cache.json")
+CACHE_MAX_TEMPERATURE = 0.2
+
+_cache = None
+_cache_stats = {"hits": 0, "misses": 0}
+_cache_lock = threading.Lock() # Speculative attempts query from worker threads
+
+# Validated results for this process (also opt-in), keyed by canonical prompt + validator
+_session_cache = {}
+_SESSION_CACHE_SIZE = 64
+
+def _cache_key(model, prompt, max_tokens, temperature):
+    """Stable hash of everything that influences the completion."""
+    raw = json.dumps([model, prompt, max_tokens, temperature], sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _load_cache():
+    """Lazily loads the on-disk cache into memory."""
+    global _cache
+    if _cache is None:
+        try:
+            with open(CACHE_FILE, "r", encoding="utf-8") as f:
+                _cache = json.load(f)
+        except (OSError, ValueError):
+            _cache = {}
+    return _cache
+
+def _save_cache():
+    """Writes the cache atomically (temp file + rename) so a crash never corrupts it."""
+    directory = os.path.dirname(CACHE_FILE) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(_cache, f, ensure_ascii=False)
+        os.replace(tmp_path, CACHE_FILE)
+    except OSError as e:
+        print(f"Cache write failed: {e}")
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+def _cache_get(prompt, max_tokens, temperature):
+    """Cached reply for this exact call, or None (also when caching is off)."""
+    if not CACHE_ENABLED or temperature > CACHE_MAX_TEMPERATURE: return None
+    key = _cache_key(MODEL, prompt, max_tokens, temperature)
+    with _cache_lock:
+        cached = _load_cache().get(key)
+        _cache_stats["hits" if cached is not None else "misses"] += 1
+    return cached
+
+def _cache_put(prompt, max_tokens, temperature, content):
+    """Stores a reply; callers only pass content that parsed (and, where possible, validated)."""
+    if not CACHE_ENABLED or temperature > CACHE_MAX_TEMPERATURE: return
+    key = _cache_key(MODEL, prompt, max_tokens, temperature)
+    with _cache_lock:
+        if _load_cache().get(key) == content: return # Cache hit being re-stored
+        _cache[key] = content
+        _save_cache()
+
+@atexit.register
+def _report_cache_stats():
+    if _cache_stats["hits"] or _cache_stats["misses"]:
+        print(f"LLM cache: {_cache_stats['hits']} hits, {_cache_stats['misses']} misses")
+
+def query_llama(prompt, max_tokens=1000, temperature=0.1, max_items=None, stream=False, stop=None, cache=True):
     """
     Raw API call to Llama 3.1.
+    stream=True streams the reply and stops once the JSON value is complete;
+    max_items (implies streaming) also cuts a JSON array after that many items.
+    stop (a threading.Event, implies streaming) abandons the reply once set; returns None.
+    cache=False skips the response cache lookup.
     """
+    cached = _cache_get(prompt, max_tokens, temperature) if cache else None
+    if cached is not None:
+        return cached
+
     payload = {
-        "model": "meta-llama/Llama-3.1-8B-Instruct",
+        "model": MODEL,
         "messages": [{"role": "user", "content": prompt}],
         "max_tokens": max_tokens,
         "temperature": temperature
     }
 
     try:
-        resp = requests.post(API_URL, headers=HEADERS, json=payload, timeout=60)
-        resp.raise_for_status() # Standard way to handle HTTP errors
-        
-        data = resp.json()
-        return data["choices"][0]["message"]["content"]
+        if stream or max_items or stop:
+            content = _stream_json(payload, max_items, stop)
+        else:
+            resp = _get_session().post(API_URL, json=payload, timeout=60)
+            resp.raise_for_status() # Standard way to handle HTTP errors
+            
+            data = resp.json()
+            content = data["choices"][0]["message"]["content"]
         
     except Exception as e:
         print(f"API Error: {e}")
         return None
 
-def _parse_json_block(text):
+    return content
+
+def _stream_json(payload, max_items=None, stop=None):
     """
-    Extracts JSON block from text.
+    Streams the completion (SSE) and decodes the JSON reply as it arrives.
+    The response is closed (stopping generation) as soon as the top-level object or
+    array is complete, or once an array holds `max_items` items, so trailing
+    explanations and surplus items are never generated.
+    If `stop` gets set, the response is closed and None is returned.
     """
+    if stop is not None and stop.is_set(): return None
+    resp = _get_session().post(API_URL, json={**payload, "stream": True}, timeout=60, stream=True)
+    resp.raise_for_status()
+    
+    decoder = json.JSONDecoder()
+    content = ""
+    start = None # Index of the opening bracket/brace
+    pos, count = None, 0 # Scan position inside an array, complete items so far
+    
+    try:
+        # Raw bytes: SSE is UTF-8, but without a charset requests would decode as ISO-8859-1
+        for line in resp.iter_lines():
+            if stop is not None and stop.is_set(): return None # Another attempt already won
+            if not line or not line.startswith(b"data:"): continue
+            chunk = line[5:].strip().decode("utf-8")
+            if chunk == "[DONE]": break
+            
+            choices = json.loads(chunk).get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content") or ""
+            content += delta
+            
+            if start is None:
+                match = _BRACE_RE.search(content)
+                if not match: continue
+                start = match.start()
+                pos = start + 1
+            
+            # Object reply: stop as soon as the top-level object closes
+            if content[start] == "{":
+                if "}" in delta:
+                    try:
+                        _, end = decoder.raw_decode(content, start)
+                        return content[:end]
+                    except ValueError:
+                        pass # Still incomplete
+                continue
+            
+            # Array reply: decode every item that is complete so far
+            while True:
+                item_start = pos
+                while item_start < len(content) and content[item_start] in " \t\r\n,": item_start += 1
+                if item_start >= len(content): break
+                if content[item_start] == "]":
+                    return content[:item_start + 1]
+                try:
+                    item, end = decoder.raw_decode(content, item_start)
+                except ValueError:
+                    break # Item still incomplete
+                if not isinstance(item, (dict, list)) and end == len(content): break # Number may be cut
+                pos, count = end, count + 1
+            
+            if max_items and count >= max_items:
+                return content[:pos] + "]"
+    finally:
+        resp.close()
+        
+    return content
+
+def _parse_json_block(text):
+    """Extracts JSON block from text."""
     if not text: return None
     
+    # 0. Fast path: most replies are already pure JSON
+    if text.lstrip()[:1] in ("[", "{"):
+        try:
+            return _json_loads(text)
+        except ValueError:
+            pass
+    
     # 1. Try finding a markdown block
-    match = re.search(r'```json\s*(.*?)\s*```', text, re.DOTALL)
+    match = _MD_RE.search(text)
     if match:
         text = match.group(1)
         
     # 2. Try finding the first/last brace
     try:
-        start = re.search(r'[\[\{]', text).start()
+        start = _BRACE_RE.search(text).start()
         end = max(text.rfind(']'), text.rfind('}')) + 1
-        return json.loads(text[start:end])
-    except (AttributeError, ValueError, json.JSONDecodeError):
+        return _json_loads(text[start:end])
+    except (AttributeError, ValueError):
         return None
 
-def query_llama_json(prompt, max_tokens=2000):
-    """Returns parsed JSON object or None."""
-    raw_text = query_llama(prompt, max_tokens)
-    return _parse_json_block(raw_text)
+@lru_cache(maxsize=64)
+def _stack_json_cached(items):
+    return json.dumps(dict(items))
+
+def stack_json(stack):
+    """Canonical (key-sorted) JSON of a tech stack, memoized so prompts stay byte-identical."""
+    stack = stack or {}
+    try:
+        return _stack_json_cached(tuple(sorted(stack.items())))
+    except TypeError: # Unhashable values (e.g. lists) can't be cache keys
+        return json.dumps(stack, sort_keys=True)
+
+def dumps_json(obj):
+    """Indented JSON string for display (orjson when installed)."""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(obj, indent=2, ensure_ascii=False)
+
+def write_json(obj, filename):
+    """Writes obj as indented UTF-8 JSON; orjson encodes straight to bytes when installed."""
+    if orjson:
+        with open(filename, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(obj, f, indent=2, ensure_ascii=False)
+
+def query_llama_json(prompt, max_tokens=2000, temperature=0.1, max_items=None, stream=False, stop=None, cache=True):
+    """
+    Returns parsed JSON object or None.
+    Replies are cached only once they parse; cache=False bypasses the cache (the caller manages it).
+    """
+    raw_text = query_llama(prompt, max_tokens, temperature, max_items, stream, stop, cache)
+    data = _parse_json_block(raw_text)
+    if data is not None and cache:
+        _cache_put(prompt, max_tokens, temperature, raw_text)
+    return data
+
+def _feedback_prompt(prompt, error_msg):
+    """Appends the validation error (or a not-JSON notice) to the original prompt."""
+    if error_msg is None:
+        return f"{prompt}\n\n PREVIOUS OUTPUT WAS NOT JSON.\nReturn ONLY valid JSON."
+    return f"{prompt}\n\n PREVIOUS OUTPUT INVALID: {error_msg}\nEnsure strict JSON compliance."
+
+def _canonical_key(prompt, max_tokens, validator_fn):
+    """Whitespace-insensitive key, so reformatted but identical prompts share an entry."""
+    canonical = " ".join(prompt.split())
+    validator = f"{validator_fn.__module__}.{validator_fn.__qualname__}"
+    return hashlib.sha256(f"{validator}:{max_tokens}:{canonical}".encode("utf-8")).hexdigest()
+
+def _check(data, validator_fn, repair_fn):
+    """
+    Validates data; if invalid, tries a local repair before paying for another LLM call.
+    Returns (valid data, None) or (None, error message).
+    """
+    is_valid, error_msg = validator_fn(data)
+    if is_valid:
+        return data, None
+    if repair_fn:
+        repaired = repair_fn(data)
+        if repaired and validator_fn(repaired)[0]:
+            return repaired, None
+    return None, error_msg
 
-def query_llama_with_validation(prompt, validator_fn, max_retries=3, max_tokens=3000):
+def _speculative_attempts(prompt, validator_fn, count, max_tokens, max_items=None, repair_fn=None):
+    """
+    Fires `count` first attempts concurrently at spread temperatures.
+    Attempts are streamed so the losers can be abandoned once one of them is valid.
+    Returns (first valid data, None) or (None, last error message).
+    """
+    temperatures = [round(0.1 + 0.2 * i, 1) for i in range(count)]
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=count)
+    futures = [pool.submit(query_llama_json, prompt, max_tokens, t, max_items, True, stop, False) for t in temperatures]
+    last_error = None
+    
+    try:
+        for future in as_completed(futures):
+            data = future.result()
+            if not data: continue
+            valid, error_msg = _check(data, validator_fn, repair_fn)
+            if valid:
+                return valid, None
+            last_error = error_msg
+    finally:
+        # Losers close their streams (stopping generation) at their next line
+        stop.set()
+        pool.shutdown(wait=False)
+        
+    return None, last_error
+
+def query_llama_with_validation(prompt, validator_fn, max_retries=3, max_tokens=3000, speculative=1, max_items=None, repair_fn=None):
     """
     Retry loop that feeds validation errors back to the LLM.
     validator_fn(data) -> (bool, "error message")
+    repair_fn(data) -> fixed data; tried locally before each retry round-trip.
+    speculative > 1 runs that many first attempts in parallel and keeps the first valid one.
+    max_items stops streaming a JSON array reply once enough items have arrived.
+    With LLM_CACHE_ENABLED, validated results are reused for identical prompts within this session.
     """
+    if not CACHE_ENABLED:
+        return _validated_query(prompt, validator_fn, max_retries, max_tokens, speculative, max_items, repair_fn)
+    
+    key = _canonical_key(prompt, max_tokens, validator_fn)
+    if key in _session_cache:
+        return copy.deepcopy(_session_cache[key])
+    
+    result = _validated_query(prompt, validator_fn, max_retries, max_tokens, speculative, max_items, repair_fn)
+    if result is not None:
+        _session_cache[key] = copy.deepcopy(result)
+        if len(_session_cache) > _SESSION_CACHE_SIZE:
+            del _session_cache[next(iter(_session_cache))] # Drop the oldest entry
+    return result
+
+def _validated_query(prompt, validator_fn, max_retries, max_tokens, speculative, max_items, repair_fn):
+    """
+    Cached validated result if there is one, else a fresh round of attempts.
+    Only the final validated result is cached (under the original prompt), never a failing attempt.
+    """
+    cached = _parse_json_block(_cache_get(prompt, max_tokens, 0.1))
+    if cached is not None:
+        valid, _ = _check(cached, validator_fn, repair_fn)
+        if valid:
+            return valid
+    
+    result = _run_attempts(prompt, validator_fn, max_retries, max_tokens, speculative, max_items, repair_fn)
+    if result is not None:
+        _cache_put(prompt, max_tokens, 0.1, json.dumps(result, ensure_ascii=False))
+    return result
+
+def _run_attempts(prompt, validator_fn, max_retries, max_tokens, speculative, max_items, repair_fn):
+    """Speculative first attempts (optional), then the sequential feedback loop."""
     current_prompt = prompt
+    first_attempt = 0
+    
+    if speculative > 1:
+        data, error_msg = _speculative_attempts(prompt, validator_fn, speculative, max_tokens, max_items, repair_fn)
+        if data:
+            return data
+        current_prompt = _feedback_prompt(prompt, error_msg)
+        first_attempt = 1
     
-    for i in range(max_retries + 1):
+    for i in range(first_attempt, max_retries + 1):
         if i > 0: 
             print(f"   Using retry attempt {i}...")
             
-        data = query_llama_json(current_prompt, max_tokens)
+        data = query_llama_json(current_prompt, max_tokens, max_items=max_items, cache=False)
         
         if data:
-            is_valid, error_msg = validator_fn(data)
-            if is_valid:
-                return data
+            valid, error_msg = _check(data, validator_fn, repair_fn)
+            if valid:
+                return valid
             
             # Feedback Loop: Tell LLM what is wrong
-            current_prompt = f"{prompt}\n\n PREVIOUS OUTPUT INVALID: {error_msg}\nEnsure strict JSON compliance."
+            current_prompt = _feedback_prompt(prompt, error_msg)
         else:
-            current_prompt = f"{prompt}\n\n PREVIOUS OUTPUT WAS NOT JSON.\nReturn ONLY valid JSON."
+            current_prompt = _feedback_prompt(prompt, None)
             
     print("Validation failed after retries.")
     return None
@@ -7,11 +7,17 @@ import os
 import sys
 import json
 from profile_generator import run_profile_extraction
-from billing_engine import run_billing_generation
-from analyzer import run_cost_analysis, display_report_summary, display_full_recommendations
+from analyzer import run_full_analysis, display_full_recommendations
+
+# ANSI clear + cursor home; avoids spawning a shell on every menu redraw
+_CLEAR = "\033[2J\033[H" if os.name != "nt" else None
 
 def clear_screen():
-    os.system('cls' if os.name == 'nt' else 'clear')
+    if _CLEAR:
+        sys.stdout.write(_CLEAR)
+        sys.stdout.flush()
+    else:
+        os.system('cls')
 
 def print_header():
     print("\n" + "="*70)
@@ -50,9 +56,8 @@ def main():
                 print("No profile found. Running Stage 1 first...")
                 if not run_profile_extraction(): continue
             
-            # Run Stage 2 & 3
-            if run_billing_generation():
-                run_cost_analysis()
+            # Run Stage 2 & 3 (single LLM call, falls back to separate stages)
+            run_full_analysis()
             
             input("\nPress Enter to continue...")
 
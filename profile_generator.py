@@ -2,15 +2,122 @@
 Stage 1: Project Profile Extraction
 """
 
-import json
 import re
-from llm_utils import query_llama_json
+import copy
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+try:
+    import re2 # Optional: linear-time matching for scans over user-supplied text
+except ImportError:
+    re2 = None
+from llm_utils import query_llama_json, write_json, dumps_json
 
-def extract_project_profile(description: str):
-    """Orchestrates the extraction and sanitization of the project profile."""
-    
-    # Define prompt for LLM
-    prompt = f"""
+# Profile schema
+_REQUIRED_KEYS = frozenset(["name", "budget_inr_per_month", "description", "tech_stack", "non_functional_requirements"])
+
+def _is_valid_profile(profile):
+    """Structure check: a dict with every required key (one C-level subset test)."""
+    return isinstance(profile, dict) and _REQUIRED_KEYS <= profile.keys()
+
+def _coerce_budget(profile):
+    """LLMs sometimes return the budget as "50,000" or 50000.0; normalize to int."""
+    try:
+        profile["budget_inr_per_month"] = int(float(str(profile["budget_inr_per_month"]).replace(',', '')))
+    except (ValueError, OverflowError):
+        pass # Leave as-is; the regex pass may still fix it
+
+# Sanitization patterns (compiled once)
+# Patterns run over raw descriptions use RE2 when installed; both are RE2-compatible.
+_regex = re2 or re
+# Budget: maximal digit runs; the currency prefix/suffix is checked around each run,
+# so a long run of digits is scanned once instead of retried from every offset.
+_AMOUNT_RE = _regex.compile(r'[\d,]+')
+_BUDGET_PREFIXES = ("rs", "rs.", "inr", "₹")
+_BUDGET_SUFFIXES = ("rupees", "rs")
+_NUM_RE = _regex.compile(r'\d+')
+
+def _budget_amount(text):
+    """
+    Budget digits from lowercased text: the first currency-prefixed amount ("rs 5,000", "₹5000"),
+    else the first suffixed one ("5000 rupees"). None if neither occurs.
+    """
+    suffixed = None
+    for m in _AMOUNT_RE.finditer(text):
+        start, end = m.span()
+        while start and text[start - 1].isspace():
+            start -= 1
+        if text.endswith(_BUDGET_PREFIXES, 0, start):
+            return m.group()
+        if suffixed is None:
+            while end < len(text) and text[end].isspace():
+                end += 1
+            if text.startswith(_BUDGET_SUFFIXES, end):
+                suffixed = m.group()
+    return suffixed
+
+# Map high-level concepts to synonyms found in text
+_CONCEPTS = {
+    "scalability": ["scalab", "scale", "scalable", "scalability"],
+    "cost efficiency": ["cost", "cost efficiency", "cost-effective", "cost efficient"],
+    "high availability": ["availability", "high availability", "high-availability"],
+    "security": ["security", "secure", "authentication", "authorization"],
+    "disaster recovery": ["disaster", "recovery", "backup", "failover"],
+    "monitoring": ["monitor", "monitoring", "uptime", "observability"],
+}
+# Inverted index: every synonym (and the concept name itself) -> concept
+_SYNONYM_TO_CONCEPT = {syn: c for c, syns in _CONCEPTS.items() for syn in syns + [c]}
+@lru_cache(maxsize=None)
+def _concept_pattern():
+    """
+    Single scan for all synonyms; the zero-width lookahead also reports overlapping matches.
+    Stays on stdlib re (RE2 has no lookahead); a literal alternation can't backtrack badly.
+    Built on first use and memoized for the process, so importing the CLI doesn't pay for it.
+    """
+    return re.compile("(?=(%s))" % "|".join(
+        re.escape(syn) for syn in sorted(_SYNONYM_TO_CONCEPT, key=len, reverse=True)
+    ))
+
+def _concepts_in(text):
+    """Set of concepts whose synonyms occur anywhere in text (one pass)."""
+    return {_SYNONYM_TO_CONCEPT[m.group(1)] for m in _concept_pattern().finditer(text)}
+
+# Stage 1 response cache: normalized description hash -> (stored_at, raw LLM profile)
+_PROFILE_CACHE = OrderedDict()
+_PROFILE_CACHE_SIZE = 1024
+_PROFILE_CACHE_TTL = 86400 # seconds
+_profile_cache_lock = threading.Lock() # Batch extraction runs on worker threads
+
+def _description_key(description):
+    """Case/whitespace-insensitive hash, so re-runs of the same text skip the LLM."""
+    normalized = " ".join(description.lower().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def _cached_profile(key):
+    """Returns a copy of a fresh cached profile, or None."""
+    with _profile_cache_lock:
+        entry = _PROFILE_CACHE.get(key)
+        if entry is None: return None
+        stored_at, raw_profile = entry
+        if time.time() - stored_at > _PROFILE_CACHE_TTL:
+            del _PROFILE_CACHE[key]
+            return None
+        _PROFILE_CACHE.move_to_end(key)
+    return copy.deepcopy(raw_profile) # The sanitized profile shares untouched values with it
+
+def _store_profile(key, raw_profile):
+    entry = (time.time(), copy.deepcopy(raw_profile))
+    with _profile_cache_lock:
+        _PROFILE_CACHE[key] = entry
+        _PROFILE_CACHE.move_to_end(key)
+        while len(_PROFILE_CACHE) > _PROFILE_CACHE_SIZE:
+            _PROFILE_CACHE.popitem(last=False) # Evict least recently used
+
+# Stage 1 prompt, split around the description so building it is a plain concatenation
+_PROMPT_HEAD = """
 You are an expert cloud architect.
 
 Extract a STRICT JSON object from the project description below.
@@ -22,14 +129,14 @@ RULES:
 - budget_inr_per_month MUST be an integer
 
 REQUIRED JSON STRUCTURE:
-{{
+{
   "name": "Concise project name (2–4 words)",
   "budget_inr_per_month": 0,
   "description": "One-line summary of the project",
-  "tech_stack": {{
-  }},
+  "tech_stack": {
+  },
   "non_functional_requirements": []
-}}
+}
 
 TECH STACK RULES:
 - Populate tech_stack as dynamic key-value pairs
@@ -49,108 +156,133 @@ BUDGET RULE:
 - Otherwise estimate: Small = 10000, Medium = 50000
 
 Project Description:
-{description}
+"""
+
+_PROMPT_TAIL = """
 
 Return ONLY the JSON object.
 """
 
+def extract_project_profile(description: str):
+    """Orchestrates the extraction and sanitization of the project profile."""
+    
     print("Analyzing description...")
-    raw_profile = query_llama_json(prompt, max_tokens=800)
+    key = _description_key(description)
+    raw_profile = _cached_profile(key)
+    if raw_profile is None:
+        prompt = _PROMPT_HEAD + description + _PROMPT_TAIL
+        # Streamed: generation stops as soon as the JSON object closes
+        raw_profile = query_llama_json(prompt, max_tokens=800, stream=True)
 
-    if not raw_profile:
-        print("LLM extraction failed.")
-        return None
+        if not raw_profile:
+            print("LLM extraction failed.")
+            return None
 
-    # Validate structure
-    required = ["name", "budget_inr_per_month", "description", "tech_stack", "non_functional_requirements"]
-    if not all(k in raw_profile for k in required):
-        print("Invalid JSON structure.")
-        return None
+        # Validate structure
+        if not _is_valid_profile(raw_profile):
+            print("Invalid JSON structure.")
+            return None
+        
+        _coerce_budget(raw_profile)
+        _store_profile(key, raw_profile)
 
     return _sanitize_profile(raw_profile, description)
 
+def extract_project_profiles(descriptions, max_workers=4):
+    """
+    Batch variant of extract_project_profile for programmatic use.
+    LLM calls run concurrently; results keep input order (None where extraction failed).
+    """
+    if not descriptions: return []
+    # 4 workers matches the HTTP connection pool size in llm_utils
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(descriptions))) as pool:
+        return list(pool.map(extract_project_profile, descriptions))
+
+
+def _utf8(text):
+    # UTF-8 is self-synchronizing, so `a in b` <=> `_utf8(a) in _utf8(b)`
+    return text.encode("utf-8", "surrogatepass")
+
+@lru_cache(maxsize=512)
+def _tool_needle(tool):
+    """Lowercased UTF-8 form of a tech name; batches over similar stacks hit the cache."""
+    return _utf8(tool.lower())
 
 def _sanitize_profile(profile, raw_text):
-    """Cleans up the profile to ensure accuracy against the source text."""
+    """
+    Cleans up the profile to ensure accuracy against the source text.
+    Returns a new dict (same key order); the input profile is left untouched.
+    """
     text_lower = raw_text.lower()
 
-    # 1. Budget Extraction (Regex Preference)
-    budget_match = re.search(r"(?:rs\.?|inr|₹)\s*([\d,]+)", text_lower)
-    if not budget_match:
-        budget_match = re.search(r"([\d,]+)\s*(?:rupees|rs)", text_lower)
-    
-    if budget_match:
+    # 1. Concise Description
+    # Use the first sentence of the user's input as the description
+    # (text up to the first '.' or newline; partition stops at the first hit, no list built)
+    first_sentence = raw_text.partition('.')[0].partition('\n')[0]
+    sanitized = {**profile, "description": first_sentence.strip()}
+
+    # 2. Budget Extraction (Regex Preference)
+    # A prefix-style amount anywhere wins over a suffix-style one
+    raw_budget = _budget_amount(text_lower)
+    if raw_budget:
         try:
-            profile["budget_inr_per_month"] = int(budget_match.group(1).replace(',', ''))
+            sanitized["budget_inr_per_month"] = int(raw_budget.replace(',', ''))
         except ValueError:
             pass # Keep LLM estimate if regex fails
 
-    # 2. Requirement Validation
+    # Nothing left to verify against the text (common for small projects)
+    nfrs = profile.get("non_functional_requirements")
+    stack = profile.get("tech_stack")
+    if not nfrs and not stack:
+        return sanitized
+
+    # UTF-8 view for plain substring tests. A "₹" makes text_lower a wide (UCS-2) str,
+    # which forces every ASCII needle to be widened; bytes search needs no conversion.
+    text_bytes = _utf8(text_lower)
+
+    # 3. Requirement Validation
     # Only keep NFRs if their key terms actually appear in the user's text.
-    valid_nfrs = []
-    # Map high-level concepts to synonyms found in text
-    concepts = {
-        "scalability": ["scalab", "scale", "scalable", "scalability"],
-        "cost efficiency": ["cost", "cost efficiency", "cost-effective", "cost efficient"],
-        "high availability": ["availability", "high availability", "high-availability"],
-        "security": ["security", "secure", "authentication", "authorization"],
-        "disaster recovery": ["disaster", "recovery", "backup", "failover"],
-        "monitoring": ["monitor", "monitoring", "uptime", "observability"],
-    }
-
-    for nfr in profile.get("non_functional_requirements", []):
-        nfr_clean = nfr.lower().strip()
-        
-        # Check specific metrics (e.g. "100TB")
-        nums = re.findall(r'\d+', nfr_clean)
-        if nums and all(n in text_lower for n in nums):
-            valid_nfrs.append(nfr)
-            continue
-
-        # Check concept existence
-        is_valid = False
-        for concept, keywords in concepts.items():
-            if concept in nfr_clean or any(k in nfr_clean for k in keywords):
-                # If the concept matches, verify at least one related keyword is in the raw text
-                if any(k in text_lower for k in keywords + [concept]):
-                    valid_nfrs.append(nfr.title())
-                    is_valid = True
-                    break
-        
-        # Fallback: exact string match
-        if not is_valid and nfr_clean in text_lower:
-            valid_nfrs.append(nfr)
+    if nfrs:
+        valid_nfrs = []
+        text_concepts = _concepts_in(text_lower)
 
-    profile["non_functional_requirements"] = list(set(valid_nfrs))
+        for nfr in nfrs:
+            nfr_clean = nfr.lower().strip()
+            
+            # Check specific metrics (e.g. "100TB")
+            nums = _NUM_RE.findall(nfr_clean)
+            if nums and all(_utf8(n) in text_bytes for n in nums):
+                valid_nfrs.append(nfr)
+            # Check concept existence: a concept in the NFR whose keywords also appear in the raw text
+            elif not _concepts_in(nfr_clean).isdisjoint(text_concepts):
+                valid_nfrs.append(nfr.title())
+            # Fallback: exact string match
+            elif _utf8(nfr_clean) in text_bytes:
+                valid_nfrs.append(nfr)
 
-    # 3. Tech Stack Validation
+        # Dedup while keeping the LLM's order (a set would shuffle it between runs)
+        sanitized["non_functional_requirements"] = list(dict.fromkeys(valid_nfrs))
+
+    # 4. Tech Stack Validation
     # If the tool isn't in the text, mark it 'Not Specified'
-    cleaned_stack = {}
-    for layer, tool in profile.get("tech_stack", {}).items():
-        if tool and str(tool).lower() in text_lower:
-            cleaned_stack[layer] = tool
-        else:
-            cleaned_stack[layer] = "Not Specified"
-    profile["tech_stack"] = cleaned_stack
-
-    # 4. Concise Description
-    # Use the first sentence of the user's input as the description
-    sentences = re.split(r'[\.\n]', raw_text)
-    if sentences:
-        profile["description"] = sentences[0].strip()
+    if stack:
+        sanitized["tech_stack"] = {
+            layer: tool if tool and _tool_needle(str(tool)) in text_bytes else "Not Specified"
+            for layer, tool in stack.items()
+        }
 
-    return profile
+    return sanitized
 
 def save_project_description(description: str, filename="project_description.txt"):
     """Save raw project description to file."""
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(description)
+    data = description.encode("utf-8")
+    with open(filename, "wb") as f:
+        f.write(data)
     print(f"Saved project description to {filename}")
 
 def save_project_profile(profile: dict, filename="project_profile.json"):
     """Save extracted project profile to JSON file."""
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(profile, f, indent=2, ensure_ascii=False)
+    write_json(profile, filename)
     print(f"Saved project profile to {filename}")
 
 def run_profile_extraction():
@@ -166,16 +298,14 @@ def run_profile_extraction():
     desc = "\n".join(lines).strip()
     if not desc: return None
 
-    with open("project_description.txt", "w", encoding="utf-8") as f:
-        f.write(desc)
+    save_project_description(desc)
 
     profile = extract_project_profile(desc)
     
     if profile:
-        with open("project_profile.json", "w", encoding="utf-8") as f:
-            json.dump(profile, f, indent=2)
+        save_project_profile(profile)
         print("\nProfile generated:")
-        print(json.dumps(profile, indent=2))
+        print(dumps_json(profile))
         return profile
     
     return None
@@ -0,0 +1,49 @@
+"""
+Regression checks for the fused Stage 2 + 3 call.
+The LLM is stubbed, so these run offline: python -m unittest test_joint_generation
+"""
+
+import unittest
+from unittest import mock
+
+import llm_utils
+import analyzer
+
+PROFILE = {
+    "name": "Shop Backend",
+    "budget_inr_per_month": 10000,
+    "tech_stack": {"database": "PostgreSQL"},
+    "non_functional_requirements": [],
+}
+
+class JointGenerationTest(unittest.TestCase):
+    def _generate(self, reply):
+        """Runs generate_billing_and_recs with every LLM call returning `reply`."""
+        with mock.patch.object(llm_utils, "CACHE_ENABLED", False), \
+             mock.patch.object(llm_utils, "query_llama", return_value=reply) as llm, \
+             mock.patch.object(analyzer, "generate_mock_billing", return_value=[]) as fallback, \
+             mock.patch("builtins.print"):
+            result = analyzer.generate_billing_and_recs(PROFILE)
+        return result, llm, fallback
+
+    def test_list_reply_is_retried_not_raised(self):
+        result, llm, fallback = self._generate('[{"month": "x"}]')
+        self.assertEqual(result, (None, None))
+        self.assertEqual(llm.call_count, 3) # First attempt + 2 feedback retries
+        fallback.assert_called_once_with(PROFILE)
+
+    def test_non_json_reply_falls_back(self):
+        result, llm, fallback = self._generate("Sorry, I can't do that.")
+        self.assertEqual(result, (None, None))
+        fallback.assert_called_once_with(PROFILE)
+
+    def test_billing_outside_requested_months_is_rejected(self):
+        reply = '{"billing": [{"month": "2025-01", "service": "EC2", "cost_inr": 900}], "recommendations": []}'
+        result, llm, fallback = self._generate(reply)
+        self.assertEqual(result, (None, None))
+        self.assertIn("Months to Cover", llm.call_args_list[0].args[0])
+        self.assertIn("PREVIOUS OUTPUT INVALID", llm.call_args_list[1].args[0])
+        fallback.assert_called_once_with(PROFILE)
+
+if __name__ == "__main__":
+    unittest.main()